@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # encoding: utf-8
 
 '''
@@ -49,7 +49,7 @@ from collections import defaultdict
 
 schema_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bq_schema")
 
-print schema_dir
+print(schema_dir)
 
 type_mapping = {
     "tinyint" : "integer",	# A very small integer
@@ -138,7 +138,7 @@ if __name__ == '__main__':
         tables = show_table(cur)
 
     if len(tables) == 0:
-        print "no any table"
+        print("no any table")
         exit(0)
 
     db_path = os.path.join(schema_dir, system, sid, database)
@@ -156,6 +156,6 @@ if __name__ == '__main__':
             schema.append({"name": "cdc_ts", "type": "string"})
             schema.sort(key=lambda k:k["name"])
             json.dump(schema, fp)
-        print "generate {}.{} google cloud bigquery's schema OK!".format(database, table)
+        print("generate {}.{} google cloud bigquery's schema OK!".format(database, table))
     cur.close()
     cli.close()
@@ -1,4 +1,4 @@
-#!/usr/bin/env python                                                                                                                                                                  
+#!/usr/bin/env python3                                                                                                                                                                 
 # encoding: utf-8
  
 '''
@@ -24,7 +24,7 @@ from pymysqlreplication.row_event import (
     WriteRowsEvent
 )
 import redis
-import commands
+import subprocess
 import time
  
 import rcache
@@ -49,7 +49,7 @@ def _trans_events(ets):
     return [aevents[et] for et in ets]
  
 def _trigger_dumping():
-    status, output = commands.getstatusoutput(dump_command)
+    status, output = subprocess.getstatusoutput(dump_command)
     if status != 0:
         # alarm
         logger.error("dump failed: {}".format(output))
@@ -74,7 +74,7 @@ def _get_row_values(binlogevent):
     return vals_lst
  
 def main():
-    rclient = redis.from_url(redis_url)
+    rclient = redis.from_url(redis_url, decode_responses=True)
     cache = rcache.Rcache(cache_url, server_id)
  
     log_file = rclient.get("log_file")
@@ -99,7 +99,7 @@ def main():
  
     for binlogevent in stream:
         if int(time.time()) - binlogevent.timestamp > binlog_max_latency:
-            logger.warn("latency[{}] too large".format(
+            logger.warning("latency[{}] too large".format(
                 int(time.time()) - binlogevent.timestamp))
         logger.debug("catch {}".format(binlogevent.__class__.__name__))
         if isinstance(binlogevent, RotateEvent):  #listen log_file changed event
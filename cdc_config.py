@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # encoding: utf-8
  
  
@@ -41,7 +41,7 @@ events = ["insert", "update", "delete"]
 # turn off dumping trigger if set to 0
 cache_max_rows = 2000000
  
-dump_command = "python dump2csv.py -c dump.conf"
+dump_command = "python3 dump2csv.py -c dump.conf"
  
 log_level = "INFO"
  
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # encoding: utf-8
 
 '''
@@ -24,16 +24,28 @@ Options:
   -g --gs_url=GSTORSGE          Specify the gs url for storaging dumping files
 '''
 
+import base64
 import csv
+import errno
+import gzip
+import hashlib
+import io
 import os
+import posixpath
 import time
 from functools import partial
+from contextlib import contextmanager
 from docopt import docopt
 from collections import defaultdict
+from itertools import chain
 import json
-from Queue import Queue, Empty
+from operator import itemgetter
+from queue import Queue, Empty
 import threading
-import commands
+from concurrent.futures import ThreadPoolExecutor
+import subprocess
+from google.cloud import storage
+from google.cloud.storage import transfer_manager
 
 import rcache
 import mwlogger
@@ -41,63 +53,182 @@ from datetime import datetime
 
 __version__ = "Version0.1"
 
-
-rqueue = Queue() # queue for uploading to google storage
+WRITE_BUFFER_SIZE = 1 << 20 # buffer size of csv file writing
+# csv files are compressed by gzip, bigquery loads them directly
+CSV_SUFFIX = "csv.gz"
+TMP_SUFFIX = "tmp.gz" # csv files of altered table
+COMPRESS_LEVEL = 1 # the fastest level
+
+# threads for dumping tables, too many threads make the disk slower
+DUMP_WORKERS = min(os.cpu_count() or 1, 8)
+RQUEUE_SIZE = 64 # csv files waiting for uploading at most
+UPLOAD_WORKERS = 16 # threads for uploading to google storage
+UPLOAD_BATCH_SIZE = 32 # max files of one uploading batch
+UPLOAD_TRIES = 3 # tries of uploading one file
+LARGE_FILE_SIZE = 150 * 1024 * 1024 # upload chunks in parallel if file is larger
+UPLOAD_CHUNK_SIZE = 32 * 1024 * 1024 # chunk size of large files
+LARGE_FILE_WORKERS = 8 # threads for uploading chunks of one large file
+BQ_LOAD_BATCH_SIZE = 1000 # max gstorage files of one bigquery load job
+BQ_LOAD_URLS_SIZE = 100 * 1024 # max length of the urls argument, under linux's 128KB
+# upload.info's schema, the same as "gsutil cp -L"
+UPLOAD_INFO_FIELDS = ("Source", "Destination", "Start", "End", "Md5", "UploadId",
+                      "Source Size", "Bytes Transferred", "Result", "Description")
+
+# queue for uploading to google storage, dumping is blocked when it's
+# full for avoiding disk filled up by csv files during uploading stalls
+rqueue = Queue(maxsize=RQUEUE_SIZE)
 bqueue = Queue() # queue for loading to bigquery
 
 glogger = None
 
+_known_dirs = set() # dirs of saving csv files which have been created
+
+# parsed status of upload.info and bqload.info for reading them incrementally
+_log_offsets = {} # {log: offset parsed}
+_log_fields = {} # {upload.info: fieldnames}
+_uploaded = defaultdict(set) # {upload.info: destinations uploaded}
+_loaded = defaultdict(set) # {bqload.info: gstorage urls loaded}
+_created_datasets = set() # bigquery datasets created or already exist
+
 def group_by_field(rows):
     '''
     return {(field1, field2...):[row1, row2...] ....}
     '''
-    g_rows = defaultdict(list)
+    if not rows:
+        return {}
+    # fast path: all rows have the same fields as the first one
+    keys = rows[0].keys()
+    if all(row.keys() == keys for row in rows):
+        return {tuple(sorted(keys)): rows}
 
+    g_rows = defaultdict(list)
+    fields_cache = {} # {frozenset(fields): sorted fields tuple}
     for row in rows:
-        fields = row.keys()
-        fields.sort()
-        g_rows[tuple(fields)].append(row)
+        keys = frozenset(row)
+        fields = fields_cache.get(keys)
+        if fields is None:
+            fields = fields_cache[keys] = tuple(sorted(keys))
+        g_rows[fields].append(row)
     return g_rows
 
+def _row_getter(fieldnames):
+    '''
+    return a function getting row's values tuple ordered by fieldnames
+    '''
+    getter = itemgetter(*fieldnames)
+    if len(fieldnames) == 1:
+        return lambda row: (getter(row),)
+    return getter
+
+def _row_values(fieldnames, rows):
+    '''
+    return rows as value tuples ordered by fieldnames
+    '''
+    # map keeps the loop in C, csv.writer consumes it in C too
+    return map(_row_getter(fieldnames), rows)
+
+def _make_save_dir(dump_dir, date):
+    '''
+    return dump_dir/date and create it if not exists
+    '''
+    save_dir = os.path.join(dump_dir, date)
+    if save_dir not in _known_dirs:
+        try:
+            os.makedirs(save_dir)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        _known_dirs.add(save_dir)
+    return save_dir
+
+def _new_csv_file(save_dir, table, suffix):
+    # csv_file is always a new file for the timestamp in its name
+    return os.path.join(save_dir,
+        "{}.{:.6f}.{}".format(table, time.time(), suffix))
+
+@contextmanager
+def _open_csv(csv_file):
+    '''
+    open csv_file for writing text, it's compressed by gzip
+    binary values read by rcache are written back as raw bytes
+    '''
+    with open(csv_file, 'wb', WRITE_BUFFER_SIZE) as raw:
+        with gzip.open(raw, 'wt', compresslevel=COMPRESS_LEVEL,
+                       encoding='utf-8', errors='surrogateescape',
+                       newline='') as fp:
+            yield fp
+
+def _write_csv(csv_file, fieldnames, rows):
+    # serialize all rows in memory, then write them to disk at once
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fieldnames)
+    writer.writerows(_row_values(fieldnames, rows))
+    with _open_csv(csv_file) as fp:
+        fp.write(buf.getvalue())
+    buf.close()
+
 def save2csv(dump_dir, table, trows, gs_url):
     """
     save table's rows into csv_files. csv_file like
-     'db.table.timestamp.csv'
+     'db.table.timestamp.csv.gz'
+    rows are streamed into one csv_file until a row with different fields
+    comes, then the table maybe altered and all rows are saved into
+    'db.table.timestamp.tmp.gz' files grouped by fields
     :param dump_dir:
     :param table:
-    :param trows:
+    :param trows: iterable of rows
     :param gs_url:
     :return: None
     """
     try:
-        if len(trows) == 0:
+        # skip empty rows, hgetall returns {} if the row's hash is deleted
+        # but its id is still in row_ids
+        trows = filter(None, trows)
+        first = next(trows, None)
+        if first is None:
             glogger.info("table[{}] has no rows to dump".format(table))
             return
-        g_rows = group_by_field(trows)
-        table_alter = False
-        if len(g_rows) > 1:
-            glogger.warn("table[{}] maybe altered.".format(table))
-            table_alter = True
-        for fieldnames, rows in g_rows.items():
-            save_dir = os.path.join(dump_dir, datetime.strftime(datetime.today(), "%Y%m%d"))
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir)
-            suffix = "tmp" if table_alter else "csv"
-            csv_file = os.path.join(save_dir,
-                "{}.{:.6f}.{}".format(table, time.time(), suffix))
-            glogger.info("dump to {}, rows:{}".format(csv_file, len(rows)))
-            exists = os.path.exists(csv_file)
-            with open(csv_file, 'ab+') as fp:
-                dict_writer = csv.DictWriter(fp, fieldnames=fieldnames)
-                if not exists:
-                    dict_writer.writeheader()
-                dict_writer.writerows(rows)
-            glogger.info("{} dump Done.".format(csv_file))
-            if gs_url:
+        save_dir = _make_save_dir(dump_dir,
+                                  datetime.strftime(datetime.today(), "%Y%m%d"))
+        keys = first.keys()
+        fieldnames = tuple(sorted(keys))
+        getter = _row_getter(fieldnames)
+        csv_file = _new_csv_file(save_dir, table, CSV_SUFFIX)
+        glogger.info("dump to {}".format(csv_file))
+        count = 0
+        rest = [] # rows from the first row with different fields
+        with _open_csv(csv_file) as fp:
+            writer = csv.writer(fp)
+            writer.writerow(fieldnames)
+            for row in chain([first], trows):
+                if row.keys() != keys:
+                    rest.append(row)
+                    break
+                writer.writerow(getter(row))
+                count += 1
+        glogger.info("{} dump Done, rows:{}".format(csv_file, count))
+
+        csv_files = [csv_file]
+        if rest:
+            glogger.warning("table[{}] maybe altered.".format(table))
+            rest.extend(trows)
+            tmp_file = csv_file[:-len(CSV_SUFFIX)] + TMP_SUFFIX
+            os.rename(csv_file, tmp_file)
+            csv_files = [tmp_file]
+            for fieldnames, rows in group_by_field(rest).items():
+                tmp_file = _new_csv_file(save_dir, table, TMP_SUFFIX)
+                glogger.info("dump to {}, rows:{}".format(tmp_file, len(rows)))
+                _write_csv(tmp_file, fieldnames, rows)
+                glogger.info("{} dump Done.".format(tmp_file))
+                csv_files.append(tmp_file)
+            count += len(rest)
+
+        if gs_url:
+            for csv_file in csv_files:
                 glogger.info("dispatch {} to rqueue".format(csv_file))
                 rqueue.put(csv_file)
-                time.sleep(2)
-        glogger.info("table:{}, rows:{} dump OK!".format(table, len(trows)))
+        glogger.info("table:{}, rows:{} dump OK!".format(table, count))
     except:
         glogger.error("{} dump Error".format(table), exc_info=True)
         raise
@@ -116,126 +247,241 @@ def create_logger(log_dir, verbose):
     return mwlogger.MwLogger("dump", log_file, log_level=log_level)
 
 
-def _upload_by_date(csv_file, gs_url):
+def _strip_prefix(s, prefix):
+    return s[len(prefix):] if s.startswith(prefix) else s
+
+
+def _split_gs_url(gs_url):
     '''
-    -m: multi-thread
-    -n: skip files exist in gstorage
-    -L: record the file uploaded info
+    "gs://bucket/subdir" -> ("bucket", "subdir")
     '''
-    csv_pdir = os.path.dirname(csv_file)
-    date = os.path.basename(csv_pdir)
-    cmd = "gsutil -m cp -n -L {log} -r {src} {dst}".format(
-        log=os.path.join(csv_pdir, "upload.info"),
-        src=os.path.join(csv_pdir, "*.csv"),
-        dst=os.path.join(gs_url, date)
-    )
-    for tries in range(3):
-        ret, out = commands.getstatusoutput(cmd)
-        if ret == 0 or tries == 2:
-            break
-        else:
-            time.sleep(2)
-    return ret >> 8, out
+    bucket_name, _, prefix = _strip_prefix(gs_url, "gs://").partition('/')
+    return bucket_name, prefix.strip('/')
 
 
-def async_upload2gstorage_ex(gs_url):
-    while 1:
-        csv_file = rqueue.get()
-        if csv_file is None:
-            glogger.info("all csv_files upload ok, thread exit!")
-            break
-        else:
-            ret, output = _upload_by_date(csv_file, gs_url)
-            if ret != 0:
-                glogger.error("upload failed, return code:{}, out:{}".format(ret, output))
-            else:
-                glogger.info("upload ok!")
+def _file_md5(path):
+    '''
+    return base64 md5 of the file at path, the same as gstorage's md5Hash
+    '''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fp:
+        for block in iter(partial(fp.read, 1024 * 1024), b''):
+            md5.update(block)
+    return base64.b64encode(md5.digest()).decode()
 
 
-def group_lst(csvs):
-    to_ups = []
-    pre_date = cur_date = None
+def _upload_file(bucket, csv_file, dst):
+    '''
+    upload csv_file to gstorage object dst of bucket
+    return the upload.info row of csv_file
+    '''
+    blob = bucket.blob(dst)
+    size = os.path.getsize(csv_file)
+    start = datetime.utcnow()
+    md5 = None
+    if size > LARGE_FILE_SIZE:
+        # upload chunks of large files in parallel by XML multipart upload
+        transfer_manager.upload_chunks_concurrently(
+            csv_file, blob, content_type="application/gzip",
+            chunk_size=UPLOAD_CHUNK_SIZE,
+            worker_type=transfer_manager.THREAD,
+            max_workers=LARGE_FILE_WORKERS)
+        # objects of XML multipart upload have no md5Hash, compute it locally
+        md5 = _file_md5(csv_file)
+    else:
+        # files up to 8MB are uploaded by one multipart request, larger
+        # ones by the resumable protocol of the client
+        blob.upload_from_filename(csv_file, content_type="application/gzip")
+    return {
+        "Source": "file://" + csv_file,
+        "Destination": "gs://{}/{}".format(bucket.name, dst),
+        "Start": start.isoformat() + 'Z',
+        "End": datetime.utcnow().isoformat() + 'Z',
+        "Md5": md5 or blob.md5_hash,
+        "Source Size": size,
+        "Bytes Transferred": size,
+        "Result": "OK",
+    }
+
+
+def _upload_files(pool, bucket, csvs, dst_dir):
+    '''
+    upload csvs to dst_dir of bucket in parallel and record
+    the uploaded files into upload.info
+    return {csv_file: error} of the files uploaded failed
+    '''
+    futures = [(csv_f, pool.submit(_upload_file, bucket, csv_f,
+                posixpath.join(dst_dir, os.path.basename(csv_f))))
+               for csv_f in csvs]
+    ups = []
+    fails = {}
+    for csv_f, future in futures:
+        try:
+            ups.append(future.result())
+        except Exception as err:
+            fails[csv_f] = err
+
+    if ups:
+        log = os.path.join(os.path.dirname(csvs[0]), "upload.info")
+        exists = os.path.exists(log)
+        with open(log, 'a', newline='') as fp:
+            dict_writer = csv.DictWriter(fp, fieldnames=UPLOAD_INFO_FIELDS)
+            if not exists:
+                dict_writer.writeheader()
+            dict_writer.writerows(ups)
+    return fails
+
+
+def _date_of(csv_file):
+    '''
+    csv_file is saved in dump_dir/yyyymmdd/
+    '''
+    return os.path.basename(os.path.dirname(csv_file))
+
+
+def _chunked(lst, size):
+    for i in range(0, len(lst), size):
+        yield lst[i:i + size]
+
+
+def _chunked_urls(urls, size, max_len):
+    '''
+    yield chunks of at most size urls whose ','.join is less than max_len
+    '''
+    chunk, length = [], 0
+    for url in urls:
+        if chunk and (len(chunk) >= size or length + 1 + len(url) > max_len):
+            yield chunk
+            chunk, length = [], 0
+        length += len(url) + (1 if chunk else 0)
+        chunk.append(url)
+    if chunk:
+        yield chunk
+
+
+def upload_csvs(pool, bucket, prefix, csvs):
+    by_date = defaultdict(list)
     for csv_f in csvs:
-        csv_pdir = os.path.dirname(csv_f)
-        cur_date = os.path.basename(csv_pdir)
-        if pre_date is None or pre_date == cur_date:
-            to_ups.append(csv_f)
-            if len(to_ups) >= 8:
-                to_ups = yield to_ups
-                yield  # yield to send
-        else:
-            to_ups = yield to_ups
-            yield  # yield to send
-            to_ups.append(csv)
-        pre_date = cur_date
-    to_ups = yield to_ups
-    yield  # yield to send
-
-
-def upload_csvs(gs_url, csvs):
-    loop_times = 0
-    gen = group_lst(csvs)
-    for gcsvs in gen:
-        if len(gcsvs) == 0:
-            break
-        glogger.info("start uploading {} to gstorage".format(str(gcsvs)))
+        by_date[_date_of(csv_f)].append(csv_f)
+    for date, gcsvs in by_date.items():
         csv_pdir = os.path.dirname(gcsvs[0])
-        date = os.path.basename(csv_pdir)
-        cmd = "gsutil -m cp -n -L {log} {src} {dst}/".format(
-            log=os.path.join(csv_pdir, "upload.info"),
-            src=' '.join(gcsvs),
-            dst=os.path.join(gs_url, date)
-        )
-        ret, out = _run_cmd_retry(cmd, 3)
-        if ret == 0:
-            glogger.info("upload successfully, files count:{}".format(len(gcsvs)))
-            gen.send([])
-        else:
-            # should check and upload failed files to google cloud storage manually
-            glogger.error("{} run error. ret:{}, out:{}".format(
-                cmd, ret, out
-            ))
-            # parse success from log_file, upload.info's schema:
-            # Source,Destination,Start,End,Md5,UploadId,Source Size,Bytes Transferred,Result,Description
-            loop_times += 1
-            if loop_times < 3: # avoid endless loop
-                log = os.path.join(csv_pdir, "upload.info")
-                with open(log) as fp:
-                    _ups = list(csv.DictReader(fp))
-                sources = [up['Source'].strip("file://") for up in _ups]
-                # retry in next loop
-                gen.send(list(set(gcsvs) - set(sources)))
+        dst_dir = posixpath.join(prefix, date)
+        for chunk in _chunked(gcsvs, UPLOAD_BATCH_SIZE):
+            glogger.info("start uploading {} to gstorage".format(str(chunk)))
+            fails = _upload_files(pool, bucket, chunk, dst_dir)
+            for tries in range(1, UPLOAD_TRIES):
+                if not fails:
+                    break
+                glogger.warning("upload {} failed, retry {}".format(
+                    str(list(fails)), tries))
+                time.sleep(2)
+                # retry the failed files only
+                fails = _upload_files(pool, bucket, list(fails), dst_dir)
+            if not fails:
+                glogger.info("upload successfully, files count:{}".format(len(chunk)))
             else:
-                gen.send([])
+                # should check and upload failed files to google cloud storage manually
+                for csv_f, err in fails.items():
+                    glogger.error("upload {} failed: {!r}".format(csv_f, err))
 
         glogger.info("start load gstorage csv files to bigquery......")
         bqueue.put(csv_pdir)
         #load2bq(csv_pdir)
 
 
+def _read_new_lines(log):
+    '''
+    return the complete lines appended to log since last reading
+    '''
+    offset = _log_offsets.get(log, 0)
+    if not os.path.exists(log):
+        return []
+    with open(log, 'rb') as fp:
+        fp.seek(offset)
+        data = fp.read()
+    # the last line may be being written
+    end = data.rfind(b'\n') + 1
+    _log_offsets[log] = offset + end
+    return data[:end].decode('utf-8').splitlines()
+
+
+def _sync_upload_log(upload_log):
+    '''
+    parse the new rows of upload.info
+    return all destinations uploaded
+    '''
+    lines = _read_new_lines(upload_log)
+    if lines and upload_log not in _log_fields:
+        _log_fields[upload_log] = next(csv.reader(lines[:1]))
+        del lines[0]
+    uploadeds = _uploaded[upload_log]
+    if lines:
+        reader = csv.DictReader(lines, fieldnames=_log_fields[upload_log])
+        uploadeds.update(up['Destination'] for up in reader)
+    return uploadeds
+
+
+def _make_dataset(dataset, datasets_log):
+    '''
+    create bigquery dataset and record it into datasets_log after success
+    '''
+    cmd = ["bq", "mk", dataset]
+    ret, out = _run_cmd_retry(cmd, 3)
+    glogger.debug("cmd:{}, ret={}, out={}".format(' '.join(cmd), ret, out))
+    if not (ret == 0 or ret == 1 and "already exists" in out):
+        glogger.error("Dataset[{}] may not exists and create it failed".format(dataset))
+        return
+    _created_datasets.add(dataset)
+    with open(datasets_log, 'a') as fp:
+        fp.write(dataset + '\n')
+
+
+def _bq_load(load_cmd, urls, bq_fp, loadeds):
+    '''
+    load urls by one bigquery job and record them into bqload.info
+    return True if successfully
+    '''
+    cmd = load_cmd + [','.join(urls)]
+    glogger.debug("load to bigqeury command: {}".format(' '.join(cmd)))
+    ret, out = _run_cmd_retry(cmd, 3)
+    if ret == 0:
+        glogger.info("load {} to bigquery successfully".format(str(urls)))
+        bq_fp.writelines(url + '\n' for url in urls)
+        loadeds.update(urls)
+        return True
+    # should check and load failed files to bigquery manually
+    glogger.error("load {} to bigquery failed. msg is {} "
+                  "Please check command ['{}'] manually".format(str(urls), out, ' '.join(cmd)))
+    return False
+
+
 def load2bq(upload_dir):
     upload_log = os.path.join(upload_dir, "upload.info")
     bq_log = os.path.join(upload_dir, "bqload.info")
-
-    to_loads = loadeds = []
-    if os.path.exists(bq_log):
-        with open(bq_log, 'r') as fp:
-            loadeds = fp.readlines()
-        loadeds = [load.strip() for load in loadeds]
-
-    with open (upload_log, 'r') as fp:
-        _ups = list(csv.DictReader(fp))
-        gs_urls = [up['Destination'] for up in _ups]
-
-    to_loads = list(set(gs_urls) - set(loadeds))
+    datasets_log = os.path.join(upload_dir, "bq_datasets.info")
+
+    _created_datasets.update(ds.strip() for ds in _read_new_lines(datasets_log))
+    loadeds = _loaded[bq_log]
+    loadeds.update(load.strip() for load in _read_new_lines(bq_log))
+    to_loads = _sync_upload_log(upload_log) - loadeds
+
+    # group files by table for loading them by one job
+    grouped = defaultdict(list)
+    for gs_url in to_loads:
+        glogger.debug(gs_url)
+        # gs://bucket/.../system/sid/date/db.table.timestamp.csv.gz
+        parts = _strip_prefix(gs_url, "gs://").split('/')
+        if len(parts) < 5:
+            glogger.error("Invalid gstorage url: {}. Ignore it".format(gs_url))
+            continue
+        db, tb = parts[-1].split('.')[:2]
+        # files of altered table have different fields, load them one by one
+        is_tmp = parts[-1].endswith(TMP_SUFFIX)
+        grouped[(parts[-4], parts[-3], db, tb, is_tmp)].append(gs_url)
 
     # load all uploaded files to bigquery
     with open(bq_log, 'a') as fp:
-        for gs_url in to_loads:
-            glogger.debug(gs_url)
-            [_, system, sid, _, csv_file] = gs_url.strip("gs://").split('/')
-            db = csv_file.split('.')[0]
-            tb = csv_file.split('.')[1]
+        for (system, sid, db, tb, is_tmp), gs_urls in grouped.items():
             schema = os.path.join("bq_schema",
                                   system,
                                   sid,
@@ -244,62 +490,84 @@ def load2bq(upload_dir):
 
             #bqDataset = "{}:{}:{}".format(system, sid, db)
             bqDataset = db # Not support the same database name from different systems
-            ret, out = _run_cmd_retry("bq mk {}".format(bqDataset), 3)
-            glogger.debug("cmd:{}, ret={}, out={}".format("bq mk {}".format(bqDataset), ret, out))
-            if not (ret == 0 or ret == 1 and "already exists" in out):
-                glogger.error("Dataset[{}] may not exists and create it failed".format(bqDataset))
+            if bqDataset not in _created_datasets:
+                _make_dataset(bqDataset, datasets_log)
 
+            load_cmd = ["bq", "load", "--skip_leading_rows=1", "--allow_quoted_newlines"]
             if not os.path.exists(schema):
-                glogger.warn("Not found schema: {}. Ignore it".format(schema))
-                cmd = "bq load --skip_leading_rows=1 --allow_quoted_newlines" \
-                      " {}.{} {}".format(bqDataset, tb, gs_url)
-            else:
-                cmd = "bq load  --schema={} --skip_leading_rows=1 --allow_quoted_newlines" \
-                      " {}.{} {}".format(schema, bqDataset, tb, gs_url)
-            glogger.debug("load to bigqeury command: {}".format(cmd))
-            ret, out = _run_cmd_retry(cmd, 3)
-            if ret == 0:
-                glogger.info("load {} to bigquery successfully".format(gs_url))
-                fp.write(gs_url + '\n')
+                glogger.warning("Not found schema: {}. Ignore it".format(schema))
             else:
-                # should check and load failed files to bigquery manually
-                glogger.error("load {} to bigquery failed. msg is {} "
-                              "Please check command ['{}'] manually".format(gs_url, out, cmd))
+                load_cmd.append("--schema={}".format(schema))
+            load_cmd.append("{}.{}".format(bqDataset, tb))
+            batch_size = 1 if is_tmp else BQ_LOAD_BATCH_SIZE
+            for urls in _chunked_urls(gs_urls, batch_size, BQ_LOAD_URLS_SIZE):
+                if not _bq_load(load_cmd, urls, fp, loadeds) and len(urls) > 1:
+                    # load one by one for the good files not blocked by bad ones
+                    for url in urls:
+                        _bq_load(load_cmd, [url], fp, loadeds)
 
 
-def _run_cmd_retry(cmd, tries=1):
+def _run_cmd_retry(argv, tries=1):
+    '''
+    run argv without shell, return (exit status, stdout and stderr)
+    '''
     for t in range(tries):
-        ret, out = commands.getstatusoutput(cmd)
+        try:
+            proc = subprocess.Popen(argv, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    universal_newlines=True)
+        except OSError as err:
+            # e.g. command not found or argument list too long, the
+            # same status as shell returns and no use to retry
+            return 127, str(err)
+        out = proc.communicate()[0].rstrip('\n')
+        ret = proc.returncode
         if ret == 0 or t == tries - 1:
             break
         else:
             time.sleep(1)
-    return ret >> 8, out
+    return ret, out
 
 
-def async_upload2gstorage(gs_url):
-    csvs = []
-    while 1:
-        while not rqueue.empty():
-            csvs.append(rqueue.get_nowait())
-        if not csvs:
-            time.sleep(0.1)
-            continue
-        if csvs[-1] is None:
-            del csvs[-1]
-            break
-        upload_csvs(gs_url, csvs)
-        del csvs[:]
-    if len(csvs) > 0:
-        upload_csvs(gs_url, csvs)
-    bqueue.put(None)
+def async_upload2gstorage(bucket, prefix):
+    '''
+    keep draining rqueue even if uploading failed, otherwise dumping
+    would be blocked by the full rqueue forever
+    '''
+    pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS)
+    over = False
+    try:
+        while not over:
+            # block until one csv file arrives, then drain the others in queue
+            csvs = [rqueue.get()]
+            while 1:
+                try:
+                    csvs.append(rqueue.get_nowait())
+                except Empty:
+                    break
+            if None in csvs:
+                del csvs[csvs.index(None):]
+                over = True
+            if csvs:
+                try:
+                    upload_csvs(pool, bucket, prefix, csvs)
+                except Exception:
+                    # should check and upload failed files to google cloud storage manually
+                    glogger.error("upload {} error".format(str(csvs)), exc_info=True)
+    finally:
+        pool.shutdown()
+        bqueue.put(None)
 
 
 def async_load2bigquery():
     while 1:
         csv_dir = bqueue.get()
         if csv_dir:
-            load2bq(csv_dir)
+            try:
+                load2bq(csv_dir)
+            except Exception:
+                # should check and load the files of csv_dir to bigquery manually
+                glogger.error("load {} to bigquery error".format(csv_dir), exc_info=True)
         else:
             break
 
@@ -325,7 +593,8 @@ def main():
     verbose = options['--verbose']
 
     if config_file:
-        cfg = json.load(file(config_file))
+        with open(config_file) as fp:
+            cfg = json.load(fp)
         cache_url = cfg['cache_url']
         server_id = cfg['server_id']
         max_rows = cfg['max_rows']
@@ -335,7 +604,7 @@ def main():
     else:
         cache_url = options['--cache_url']
         server_id = options['--server_id']
-        max_rows = options['--max_rows']
+        max_rows = int(options['--max_rows'])
         log_dir = options['--log_dir']
         dump_dir = options['--dump_dir']
         gs_url = options['--gs_url']
@@ -349,19 +618,23 @@ def main():
 
     if gs_url:
         gs_url = os.path.join(gs_url, str(server_id))
-        upload_thr = threading.Thread(target=async_upload2gstorage, args=(gs_url,))
-        upload_thr.setDaemon(True)
+        # create the client before dumping for failing early, e.g. without credentials
+        bucket_name, prefix = _split_gs_url(gs_url)
+        bucket = storage.Client().bucket(bucket_name)
+        upload_thr = threading.Thread(target=async_upload2gstorage,
+                                      args=(bucket, prefix))
+        upload_thr.daemon = True
         upload_thr.start()
         glogger.info("upload csv files to {} thread running...".format(gs_url))
         load_thr = threading.Thread(target=async_load2bigquery)
-        load_thr.setDaemon(True)
+        load_thr.daemon = True
         load_thr.start()
         glogger.info("load to bigquery threading running....")
 
     glogger.info("start dump from cache to csv files")
 
     callback = partial(save2csv, dump_dir, gs_url=gs_url)
-    cache.dump_t(callback, max_rows, dump_tables)
+    cache.dump_t(callback, max_rows, dump_tables, DUMP_WORKERS)
     glogger.info("dump complete!")
     if gs_url:
         glogger.info("wait uploading to gstorage and loading to bigquery threads completed......")
@@ -1,5 +1,5 @@
 
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # encoding: utf-8
 
 '''
@@ -24,6 +24,7 @@ Options:
 '''
 
 import csv
+import gzip
 import os
 import time
 from functools import partial
@@ -48,7 +49,8 @@ def main():
     primary_key = options['<primary_key>']
 
     if config_file:
-        cfg = json.load(file(config_file))
+        with open(config_file) as fp:
+            cfg = json.load(fp)
         cache_url = cfg['cache_url']
         server_id = cfg['server_id']
         log_dir = cfg.get('log_dir', None)
@@ -82,14 +84,21 @@ def create_logger(log_dir, verbose):
 
 def _get_table_name(csv_file):
     '''
-    support csv_file like "db.table.csv" and "db.table.timestamp.csv"
+    support csv_file like "db.table.csv", "db.table.timestamp.csv"
+    and "db.table.timestamp.csv.gz"
     :param csv_file:
     :return: db.table
     '''
     return ".".join(os.path.basename(csv_file).split(".")[:2])
 
 def readcsv(csv_file):
-    with open(csv_file) as fp:
+    if csv_file.endswith(".gz"):
+        fp = gzip.open(csv_file, 'rt', encoding='utf-8',
+                       errors='surrogateescape', newline='')
+    else:
+        fp = open(csv_file, encoding='utf-8', errors='surrogateescape',
+                  newline='')
+    with fp:
         for row in csv.DictReader(fp):
             yield row
 
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 '''
  Author: deng_lingfei
@@ -114,7 +114,7 @@ class MwLogger(logging.Logger, object):
         if isinstance(log_handler, logging.Handler):
             self.hdlr = log_handler
 
-        elif isinstance(log_handler, basestring):
+        elif isinstance(log_handler, str):
             if log_handler == 'syslog':
                 self.hdlr = SysLogHandler(
                     address="/dev/log", facility=SysLogHandler.facility_names.get(facility, 1))
@@ -253,7 +253,7 @@ if __name__ == '__main__':
 
     logger.debug('debug log......')
     logger.info('info log..........')
-    logger.warn('warn log..........')
+    logger.warning('warn log..........')
     logger.error('error log..........')
     logger.critical('critical log..........')
 
@@ -1,10 +1,12 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # encoding: utf-8
 
 import redis
 import time
 import threading
 import os
+from itertools import chain, islice
+from concurrent.futures import ThreadPoolExecutor
 
 class SaveIgnore(Exception):
     pass
@@ -13,9 +15,17 @@ class FullError(Exception):
     pass
 
 class Rcache(object):
-    def __init__(self, redis_url, mysql_server_id):
+    # rows got from redis by one pipeline at most
+    PIPELINE_SIZE = 1000
+
+    def __init__(self, redis_url, mysql_server_id, max_connections=16):
         self._redis_url = redis_url
-        self._client = redis.from_url(redis_url)
+        # binary values which are not utf-8 are kept as they are by
+        # surrogateescape, the same as bytes in python2
+        pool = redis.BlockingConnectionPool.from_url(redis_url,
+                max_connections=max_connections, decode_responses=True,
+                encoding_errors='surrogateescape')
+        self._client = redis.Redis(connection_pool=pool)
         self._server_id = mysql_server_id
         self._key_prefix = "{}#".format(mysql_server_id)
         self._locking_key = "{}#locking".format(mysql_server_id)
@@ -50,7 +60,7 @@ class Rcache(object):
         self._client.expire(self._locking_key, ex),
         self._lock_timer = threading.Timer(ex - 10,
                 self._fresh_lock, (ex,))
-        self._lock_timer.setDaemon(True)
+        self._lock_timer.daemon = True
         self._lock_timer.start()
 
 
@@ -80,10 +90,13 @@ class Rcache(object):
         keys.append(row_ids_key)
         self._client.delete(*keys)
 
-    def dump_t(self, callback, max_rows=0, dump_tables=None):
+    def dump_t(self, callback, max_rows=0, dump_tables=None, workers=1):
         '''
         callback args: (table, rows)
-        dump data table by table
+        dump data table by table, rows is an iterator of max_rows
+        rows at most and must be consumed in callback
+        tables are dumped by workers threads in parallel, so callback
+        must be thread safe if workers > 1
         '''
         if not callable(callback):
             return
@@ -91,20 +104,24 @@ class Rcache(object):
             self._get_lock()
             self._fresh_lock()
             if not dump_tables:
-                for (over, table, rows) in self.iter_rows(max_rows):
-                    callback(table, rows)
-                    if over:
-                        self._clear_table(table)
-            else:
-                for table in dump_tables:
-                    for over, rows in self.iter_rows_by_table(table):
-                        callback(table, rows)
-                        if over:
-                            self._clear_table(table)
+                dump_tables = self.tables()
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(self._dump_table, callback, table, max_rows)
+                           for table in dump_tables]
+            for future in futures:
+                future.result() # raise the error of dumping table
         finally:
             self._unfresh_lock()
             self._free_lock()
 
+    def _dump_table(self, callback, table, max_rows=0):
+        '''
+        clear the table after all rows are dumped successfully
+        '''
+        for rows in self.iter_rows_by_table(table, max_rows):
+            callback(table, rows)
+        self._clear_table(table)
+
     def clear(self):
         self._client.flushdb()
 
@@ -132,11 +149,8 @@ class Rcache(object):
         """
         return a generator like (table, row)
         """
-        for row_ids in self._iter_row_ids():
-            for row_id in self._client.sscan_iter(row_ids, count=1000):
-                table = row_ids[self._table_key_offset:]
-                row_key = "{}{}.{}".format(self._key_prefix, table, row_id)
-                row = self._client.hgetall(row_key)
+        for table in self.tables():
+            for row in self._iter_table_rows(table):
                 yield (table, row)
 
 
@@ -144,34 +158,37 @@ class Rcache(object):
         '''
         return a generator like (table, rows)
         set max_rows for avoid OOM
-        yield (iter_over_flag, table, rows)
         '''
-        for row_ids in self._iter_row_ids():
-            rows = []
-            table = row_ids[self._table_key_offset:]
-            for row_id in self._client.sscan_iter(row_ids, count=1000):
-                row_key = "{}{}.{}".format(self._key_prefix, table, row_id)
-                row = self._client.hgetall(row_key)
-                rows.append(row)
-                if max_rows and len(rows) >= max_rows:
-                    yield (False, table, rows)
-                    del rows[:]
-            yield (True, table, rows)
+        for table in self.tables():
+            for rows in self.iter_rows_by_table(table, max_rows):
+                yield (table, rows)
 
 
-    def iter_rows_by_table(self, table, max_row=0):
+    def _iter_table_rows(self, table):
         '''
-        return a generator like [row1, row2...]
+        hgetall rows by pipeline for saving round-trips
         '''
-        rows = []
         row_ids_key = "{}{}".format(self._row_ids_prefix, table)
-        for row_id in self._client.sscan_iter(row_ids_key, count=1000):
-            row_key = "{}{}.{}".format(self._key_prefix, table, row_id)
-            rows.append(self._client.hgetall(row_key))
-            if max_row and len(rows) >= max_row:
-                yield False, rows
-                del rows[:]
-        yield True, rows
+        pipe = self._client.pipeline(transaction=False)
+        for row_id in self._client.sscan_iter(row_ids_key,
+                count=self.PIPELINE_SIZE):
+            pipe.hgetall("{}{}.{}".format(self._key_prefix, table, row_id))
+            if len(pipe) >= self.PIPELINE_SIZE:
+                for row in pipe.execute():
+                    yield row
+        for row in pipe.execute():
+            yield row
+
+
+    def iter_rows_by_table(self, table, max_row=0):
+        '''
+        return a generator like rows_iter1, rows_iter2...
+        rows_iter yields max_row rows at most and is read from redis
+        lazily, it must be consumed before getting the next one
+        '''
+        rows = self._iter_table_rows(table)
+        for row in rows:
+            yield chain([row], islice(rows, max_row - 1) if max_row else rows)
 
 
     def _get_lock(self, block=True, interval=1):
@@ -252,7 +269,7 @@ class Rcache(object):
                 else:
                     self._client.delete(key)
                     self._client.srem(row_ids_key, rid)
-        except redis.ResponseError, err:
+        except redis.ResponseError as err:
             if "OOM command not allowed" in str(err):
                 raise FullError(str(err))
         finally: